@@ -1,10 +1,31 @@
 from flask import Flask, request, jsonify
+from flask.json.provider import DefaultJSONProvider
 import os
-import json
+import atexit
 import requests
+from requests.adapters import HTTPAdapter
+import urllib3
+from urllib3.util.retry import Retry
+import httpx
+import orjson
 import csv
+import hashlib
+import hmac
 import io
-from datetime import datetime
+import time
+import logging
+import queue
+import random
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+logging.basicConfig(format='%(message)s')
+logger = logging.getLogger(__name__)
+logger.setLevel(LOG_LEVEL)
 
 # Add startup logging for Railway debugging
 print("=== RAILWAY STARTUP DEBUG ===")
@@ -16,6 +37,7 @@ print("SUPABASE_SERVICE_ROLE_KEY:", "Set" if os.environ.get('SUPABASE_SERVICE_RO
 # Import with error handling
 try:
     from supabase import create_client
+    from postgrest.exceptions import APIError
     print("✓ Supabase import successful")
 except ImportError as e:
     print(f"✗ Supabase import failed: {e}")
@@ -28,153 +50,909 @@ try:
 except ImportError:
     print("✓ dotenv not available (normal on Railway)")
 
+try:
+    import psycopg
+    from psycopg import sql
+    print("✓ psycopg import successful")
+except ImportError:
+    psycopg = None
+    print("✓ psycopg not available (COPY ingest disabled)")
+
+class ORJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson for request parsing and jsonify"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # Hand orjson's bytes straight to the Response rather than going
+        # through dumps()' str and having Werkzeug encode it back again
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE),
+            mimetype=self.mimetype
+        )
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
+# Cap request bodies so an oversized webhook is refused before it's read
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv('MAX_CONTENT_LENGTH', 32 * 1024 * 1024))
 PHANTOMBUSTER_API_KEY = os.getenv("PHANTOMBUSTER_API_KEY")
 PHANTOM_AGENT_ID = os.getenv("PHANTOM_AGENT_ID")
-session_cookie = os.getenv('LINKEDIN_SESSION_COOKIE')
+LINKEDIN_SESSION_COOKIE = os.getenv('LINKEDIN_SESSION_COOKIE')
+# When set, /webhook only accepts bodies whose hex HMAC-SHA256 under this
+# secret is sent in the X-Signature header
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
 
+# The full source item is only kept in posts.raw_data when STORE_RAW=1; the
+# mapped columns already hold everything we read, and raw_data is the bulk of
+# every row's size on the wire and in the WAL
+STORE_RAW = os.getenv('STORE_RAW') == '1'
 
-# Connect to Supabase with enhanced error handling
-try:
+# With SUPABASE_INGEST_RPC=1, posts and their engagement_metrics rows are
+# written by the ingest_posts() database function in one round-trip
+# (supabase/migrations) instead of two chained upserts
+SUPABASE_INGEST_RPC = os.getenv('SUPABASE_INGEST_RPC') == '1'
+
+# Hashtags (group 1) and mentions (group 2) found in a single scan of the content
+_TAG_RE = re.compile(r'(?:(#)|(@))(\w+)')
+
+# Shared keep-alive session for PhantomBuster API calls and CSV downloads so
+# repeat calls to the same host reuse TCP+TLS connections. Only idempotent
+# requests (GET) are retried on gateway errors; agent launches are never
+# replayed. API keys stay per-request so they aren't sent to the CSV host.
+http_session = requests.Session()
+http_session.mount('https://', HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=50,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+))
+
+# PhantomBuster re-sends the same companies run after run; each process
+# remembers a fingerprint of the last COMPANY_CACHE_SIZE company rows it saved
+# (least recently saved evicted first) and skips upserting unchanged ones
+COMPANY_CACHE_SIZE = int(os.getenv('COMPANY_CACHE_SIZE', '10000'))
+company_fingerprints = OrderedDict()
+company_fingerprints_lock = threading.Lock()
+
+# Max pooled connections per worker to PostgREST; keep workers * pool size
+# below the Supabase plan's connection limit
+SUPABASE_POOL_SIZE = int(os.getenv('SUPABASE_POOL_SIZE', '10'))
+
+# Rows per posts/engagement_metrics bulk upsert; large CSVs and resultObjects
+# are written in chunks of this size to keep each request body bounded
+SUPABASE_BATCH_SIZE = int(os.getenv('SUPABASE_BATCH_SIZE', '500'))
+
+# With a direct Postgres URL (and psycopg installed), batches of at least
+# COPY_THRESHOLD posts skip PostgREST and are COPYed in one transaction.
+# Point it at the Supavisor transaction-mode pooler
+# (postgresql://postgres.<ref>:<password>@<region>.pooler.supabase.com:6543/postgres)
+# so concurrent batches across workers share the plan's connection slots;
+# psycopg rejects Prisma-style ?pgbouncer=true parameters, so leave those off
+SUPABASE_DB_URL = os.getenv('SUPABASE_DB_URL')
+COPY_THRESHOLD = int(os.getenv('COPY_THRESHOLD', '2000'))
+COPY_ENABLED = bool(SUPABASE_DB_URL) and psycopg is not None
+# Each db_executor thread keeps its own COPY connection open between batches
+copy_connections = threading.local()
+
+# Independent Supabase batches run side by side on this pool; the httpx
+# client above is thread-safe and shared
+SUPABASE_CONCURRENCY = int(os.getenv('SUPABASE_CONCURRENCY', '4'))
+db_executor = ThreadPoolExecutor(max_workers=SUPABASE_CONCURRENCY)
+
+# Webhooks are acknowledged with 202 and written to Supabase by a background
+# thread; a full queue answers 503 so PhantomBuster retries later
+webhook_queue = queue.Queue(maxsize=int(os.getenv('WEBHOOK_QUEUE_SIZE', '100')))
+webhook_worker = None
+webhook_worker_lock = threading.Lock()
+# Let queued jobs finish on graceful shutdown
+atexit.register(webhook_queue.join)
+
+# A resultObject body identical to one processed within this many seconds is
+# a retry and is skipped. CSV webhooks are never deduped: their body is only
+# the result URL, which every launch reuses for fresh data
+WEBHOOK_DEDUPE_WINDOW = int(os.getenv('WEBHOOK_DEDUPE_WINDOW', '3600'))
+# Expired webhook_events rows are deleted by the worker at most once per
+# window (monotonic time of the last prune; only the worker thread touches it)
+webhook_events_pruned_at = None
+
+# How long the worker waits for more JSON webhooks to merge into the batch it
+# is about to write (seconds); 0 writes each delivery on its own
+WEBHOOK_COALESCE_WINDOW = float(os.getenv('WEBHOOK_COALESCE_WINDOW', '0.05'))
+
+
+class ORJSONClient(httpx.Client):
+    """httpx client that encodes JSON request bodies with orjson"""
+
+    def build_request(self, method, url, *, json=None, content=None, headers=None, **kwargs):
+        # PostgREST payloads carry each post's full raw_data; orjson encodes them
+        # straight to bytes in C instead of stdlib json's str-then-encode pass
+        if json is not None:
+            content = orjson.dumps(json)
+            headers = httpx.Headers(headers)
+            headers['Content-Type'] = 'application/json'
+        return super().build_request(method, url, content=content, headers=headers, **kwargs)
+
+# The Supabase client is created lazily on first use rather than at import:
+# with gunicorn's preload_app the module is imported once in the master, and
+# each forked worker then opens its own connections instead of inheriting
+# TLS sockets it must not share
+_supabase = None
+_supabase_lock = threading.Lock()
+_table_builders = {}
+
+# Transient failures (network errors, 5xx, PostgREST pool/connection errors,
+# serialization failures and deadlocks) are retried this many times in total
+SUPABASE_MAX_ATTEMPTS = int(os.getenv('SUPABASE_MAX_ATTEMPTS', '4'))
+TRANSIENT_API_ERROR_CODES = {'PGRST000', 'PGRST001', 'PGRST002', 'PGRST003', '40001', '40P01'}
+
+def create_supabase_client():
+    """Create a Supabase client whose PostgREST session is a bounded keep-alive pool"""
     supabase_url = os.getenv('SUPABASE_URL')
     supabase_key = os.getenv('SUPABASE_SERVICE_ROLE_KEY')
     
     if not supabase_url or not supabase_key:
         raise ValueError("Missing Supabase environment variables")
     
-    supabase = create_client(supabase_url, supabase_key)
-    print("✓ Supabase client created successfully")
-except Exception as e:
-    print(f"✗ Error creating Supabase client: {e}")
-    supabase = None
-
-def calculate_engagement_rate(post):
-    """Calculate engagement rate for a post"""
-    impressions = post.get('impressions', 1) or 1  # Avoid division by zero
-    total_engagement = post.get('likes', 0) + post.get('comments', 0) + post.get('shares', 0) + post.get('clicks', 0)
-    return round((total_engagement / impressions) * 100, 2)
-
-def download_csv_from_url(csv_url):
-    """Download CSV content from PhantomBuster URL"""
-    try:
-        print(f"📥 Downloading CSV from: {csv_url}")
-        response = requests.get(csv_url, timeout=30)
-        response.raise_for_status()
-        print(f"✓ CSV downloaded successfully, size: {len(response.content)} bytes")
-        return response.text
-    except requests.exceptions.RequestException as e:
-        print(f"✗ Error downloading CSV: {e}")
-        return None
+    client = create_client(supabase_url, supabase_key)
+
+    # Swap in a bounded keep-alive pool so every .execute() reuses TLS connections
+    default_session = client.postgrest.session
+    client.postgrest.session = create_postgrest_session(default_session)
+    default_session.close()
+    atexit.register(lambda: client.postgrest.session.close())
+    return client
+
+def create_postgrest_session(template):
+    """Create a pooled PostgREST session with the same base URL and auth headers as template"""
+    return ORJSONClient(
+        base_url=template.base_url,
+        headers=template.headers,
+        timeout=httpx.Timeout(30.0),
+        # retries=1 only re-attempts failed connects, so it's safe for upserts;
+        # idle sockets are dropped before PostgREST's proxy closes them
+        transport=httpx.HTTPTransport(
+            retries=1,
+            limits=httpx.Limits(
+                max_connections=SUPABASE_POOL_SIZE,
+                max_keepalive_connections=SUPABASE_POOL_SIZE,
+                keepalive_expiry=30.0
+            )
+        )
+    )
 
-def parse_csv_content(csv_content):
-    """Parse CSV content and extract LinkedIn posts data"""
+def reset_postgrest_session(client, failed_session):
+    """Replace a PostgREST session whose pool is wedged, unless another thread already did"""
+    with _supabase_lock:
+        if client.postgrest.session is failed_session:
+            # Other threads may still be mid-request on the old session, so it
+            # is left for garbage collection rather than closed here
+            client.postgrest.session = create_postgrest_session(failed_session)
+            logger.warning("⚠ PostgREST session reset after connection failure")
+
+def get_table(client, name):
+    """Return a reusable request builder for a table, rebuilt only when the session changes"""
+    # Table builders hold just the session and path; each upsert() returns a
+    # fresh query object, so one builder per table can be shared by every call
+    builder = _table_builders.get(name)
+    if builder is None or builder.session is not client.postgrest.session:
+        builder = _table_builders[name] = client.table(name)
+    return builder
+
+def is_transient_error(error):
+    """Whether a failed Supabase call is worth retrying"""
+    if isinstance(error, httpx.TransportError):
+        return True
+    if isinstance(error, APIError):
+        # Non-JSON gateway errors carry the HTTP status as their code
+        if isinstance(error.code, int):
+            return error.code >= 500
+        return error.code in TRANSIENT_API_ERROR_CODES
+    return False
+
+def is_data_error(error):
+    """Whether a failed Supabase call was rejected for the data it carried (SQLSTATE class 22 or 23)"""
+    return isinstance(error, APIError) and isinstance(error.code, str) and error.code[:2] in ('22', '23')
+
+def write_valid_rows(write, rows, key, *args):
+    """Call write(rows, *args), halving rows on a data error so valid rows still land
+
+    Returns the sum of write's results for the slices that were written. A row
+    rejected on its own is logged by its key column and counted as 0.
+    """
     try:
-        print("📊 Parsing CSV content...")
-        csv_reader = csv.DictReader(io.StringIO(csv_content))
-        
-        posts = []
-        for row_num, row in enumerate(csv_reader, 1):
-            try:
-                # Clean up the row data (remove extra spaces)
-                cleaned_row = {k.strip(): v.strip() if isinstance(v, str) else v for k, v in row.items()}
-                posts.append(cleaned_row)
-                
-                if row_num <= 3:  # Log first 3 rows for debugging
-                    print(f"Row {row_num} keys: {list(cleaned_row.keys())}")
-                
-            except Exception as row_error:
-                print(f"⚠ Error processing row {row_num}: {row_error}")
-                continue
-        
-        print(f"✓ Parsed {len(posts)} posts from CSV")
-        return posts
-        
+        return write(rows, *args)
     except Exception as e:
-        print(f"✗ Error parsing CSV: {e}")
-        return []
+        if not is_data_error(e):
+            raise
+        if len(rows) == 1:
+            logger.error("✗ Rejected row %s=%s: %s", key, rows[0].get(key), e.message)
+            return 0
+        logger.debug("Batch of %d rows rejected (%s), splitting it", len(rows), e.message)
+        middle = len(rows) // 2
+        return (write_valid_rows(write, rows[:middle], key, *args)
+                + write_valid_rows(write, rows[middle:], key, *args))
+
+def execute_with_retry(build_query):
+    """Execute build_query(client), retrying transient failures with jittered exponential backoff
+
+    The query is rebuilt on every attempt so a reset session is picked up.
+    """
+    client = get_supabase()
+    for attempt in range(1, SUPABASE_MAX_ATTEMPTS + 1):
+        session = client.postgrest.session
+        try:
+            return build_query(client).execute()
+        except Exception as e:
+            if attempt == SUPABASE_MAX_ATTEMPTS or not is_transient_error(e):
+                raise
+            if isinstance(e, (httpx.PoolTimeout, httpx.ConnectError, httpx.RemoteProtocolError)):
+                reset_postgrest_session(client, session)
+            delay = random.uniform(0, min(5.0, 0.2 * 2 ** attempt))
+            logger.warning("⚠ Supabase call failed (attempt %d/%d): %s; retrying in %.2fs",
+                           attempt, SUPABASE_MAX_ATTEMPTS, e, delay)
+            time.sleep(delay)
+
+def get_supabase():
+    """Return this process's Supabase client, creating it on first use (None if unavailable)"""
+    global _supabase
+    if _supabase is None:
+        with _supabase_lock:
+            if _supabase is None:
+                # Connect to Supabase with enhanced error handling
+                try:
+                    _supabase = create_supabase_client()
+                    logger.info("✓ Supabase client created successfully (pool size %d)", SUPABASE_POOL_SIZE)
+                except Exception as e:
+                    logger.error("✗ Error creating Supabase client: %s", e)
+    return _supabase
+
+def iter_csv_rows(csv_url):
+    """Stream a PhantomBuster CSV and yield its rows as lists as they arrive
+
+    The first item is the header with whitespace stripped from each name.
+    """
+    logger.info("📥 Streaming CSV from: %s", csv_url)
+    with http_session.get(csv_url, stream=True, timeout=30) as response:
+        response.raise_for_status()
+
+        # Decode the socket stream directly instead of buffering response.text.
+        # requests assumes ISO-8859-1 for text/* without a charset, so fall back
+        # to UTF-8 (BOM-tolerant) unless the server actually declared one.
+        # newline='' keeps line breaks inside quoted post content intact.
+        response.raw.decode_content = True
+        # urllib3 closes the raw stream as soon as the body is fully read,
+        # which makes TextIOWrapper's next read fail on a closed file
+        response.raw.auto_close = False
+        declared = 'charset' in response.headers.get('Content-Type', '').lower()
+        stream = io.TextIOWrapper(
+            response.raw,
+            encoding=response.encoding if declared else 'utf-8-sig',
+            errors='replace',
+            newline=''
+        )
+
+        reader = csv.reader(stream)
+        header = next(reader, None)
+        if header is None:
+            return
+        header = [name.strip() for name in header]
+        logger.debug("CSV columns: %s", header)
+        yield header
+
+        for row in reader:
+            if row:  # Skip blank lines, as DictReader did
+                yield row
+
+# Accepted spellings of each CSV column, in order of preference (adjust these
+# based on your CSV headers)
+CSV_COLUMN_ALIASES = {
+    'content': ('content', 'Content', 'text', 'Text', 'postContent'),
+    'post_url': ('postUrl', 'Post URL', 'url', 'URL'),
+    'published_at': ('publishedAt', 'Published At', 'date', 'Date', 'createdAt'),
+    'author': ('author', 'Author', 'authorName', 'profileName'),
+    'likes': ('likes', 'Likes', 'likeCount'),
+    'comments': ('comments', 'Comments', 'commentCount'),
+    'shares': ('shares', 'Shares', 'shareCount', 'reposts'),
+    'impressions': ('impressions', 'Impressions', 'views'),
+    'clicks': ('clicks', 'Clicks'),
+    'post_type': ('postType', 'type'),
+}
+
+def resolve_csv_columns(header):
+    """Map each CSV_COLUMN_ALIASES field to the index of its first spelling present in the header
+
+    Fields missing from the header map to len(header), the blank cell
+    process_csv_posts appends to every row.
+    """
+    positions = {}
+    for index, name in enumerate(header):
+        positions.setdefault(name, index)
+    missing = len(header)
+    return {
+        field: next((positions[name] for name in aliases if name in positions), missing)
+        for field, aliases in CSV_COLUMN_ALIASES.items()
+    }
 
 def extract_hashtags_and_mentions(content):
     """Extract hashtags and mentions from post content"""
+    hashtags, mentions = [], []
     if not content:
-        return [], []
-    
-    import re
-    hashtags = re.findall(r'#\w+', content)
-    mentions = re.findall(r'@\w+', content)
-    
+        return hashtags, mentions
+
+    for match in _TAG_RE.finditer(content):
+        (hashtags if match.group(1) else mentions).append(match.group(0))
+
     return hashtags, mentions
 
-def process_csv_posts(posts_data):
-    """Process CSV posts data and save to Supabase"""
+def process_csv_posts(csv_rows):
+    """Save CSV post rows to Supabase in batches, returning (processed_count, row_count)
+
+    csv_rows is an iterable of row lists whose first item is the header, such as
+    the iter_csv_rows stream, so the whole CSV is never held in memory.
+    """
     processed_count = 0
+    row_count = 0
+    # Keyed by linkedin_post_id so a repeated row within one batch collapses
+    # (last wins) instead of failing the bulk upsert
+    post_rows = {}
+    metric_rows = {}
+    pending = set()
+    # Gather COPY-sized batches when COPY is available, PostgREST-sized otherwise
+    batch_size = COPY_THRESHOLD if COPY_ENABLED else SUPABASE_BATCH_SIZE
+    # One measurement timestamp for the whole file, as on the resultObject path
+    measured_at = datetime.now(timezone.utc).isoformat()
+
+    csv_rows = iter(csv_rows)
+    header = next(csv_rows, None)
+    if header is None:
+        return processed_count, row_count
+    # The header is the same for every row, so resolve column aliases once
+    columns = resolve_csv_columns(header)
+    width = len(header)
+    padding = [''] * width
     
-    for i, post in enumerate(posts_data, 1):
+    for i, row in enumerate(csv_rows, 1):
+        row_count = i
         try:
-            print(f"Processing CSV post {i}/{len(posts_data)}")
+            logger.debug("Processing CSV post %d", i)
+
+            # Normalise ragged rows to the header, then add the blank cell that
+            # columns missing from the header point at
+            if len(row) != width:
+                row = (row + padding)[:width]
+            row.append('')
             
-            # Map CSV columns to our data structure (adjust these based on your CSV headers)
-            content = post.get('content') or post.get('Content') or post.get('text') or post.get('Text') or post.get('postContent') or ''
-            post_url = post.get('postUrl') or post.get('Post URL') or post.get('url') or post.get('URL') or ''
-            published_at = post.get('publishedAt') or post.get('Published At') or post.get('date') or post.get('Date') or post.get('createdAt') or ''
-            author = post.get('author') or post.get('Author') or post.get('authorName') or post.get('profileName') or ''
+            content = row[columns['content']].strip()
+            post_url = row[columns['post_url']].strip()
+            published_at = row[columns['published_at']].strip()
+            author = row[columns['author']].strip()
+
+            # A row with no content, URL or date can't be identified or stored
+            # meaningfully (e.g. trailing blank rows in PhantomBuster exports)
+            if not (content or post_url or published_at):
+                logger.debug("Skipping empty CSV post %d", i)
+                continue
             
-            # Extract engagement metrics with flexible column names
-            likes = int(post.get('likes') or post.get('Likes') or post.get('likeCount') or 0)
-            comments = int(post.get('comments') or post.get('Comments') or post.get('commentCount') or 0)
-            shares = int(post.get('shares') or post.get('Shares') or post.get('shareCount') or post.get('reposts') or 0)
-            impressions = int(post.get('impressions') or post.get('Impressions') or post.get('views') or 0)
+            # Extract engagement metrics
+            likes = int(row[columns['likes']].strip() or 0)
+            comments = int(row[columns['comments']].strip() or 0)
+            shares = int(row[columns['shares']].strip() or 0)
+            impressions = int(row[columns['impressions']].strip() or 0)
             
             # Extract hashtags and mentions from content
             hashtags, mentions = extract_hashtags_and_mentions(content)
             
             # Generate a unique post ID
-            import hashlib
-            post_id = post_url or hashlib.md5(f"{content[:100]}{published_at}".encode()).hexdigest()
+            post_id = post_url or hashlib.blake2b(f"{content[:100]}{published_at}".encode(), digest_size=16).hexdigest()
             
-            # Insert post data
-            post_insert = supabase.table('posts').upsert({
+            record = {
                 'linkedin_post_id': post_id,
                 'content': content,
-                'post_type': post.get('postType') or post.get('type') or 'post',
+                'post_type': row[columns['post_type']].strip() or 'post',
                 'published_at': published_at,
                 'author_id': author,
                 'hashtags': hashtags,
-                'mentions': mentions,
-                'raw_data': post
-            }).execute()
-            
-            if post_insert.data and len(post_insert.data) > 0:
-                db_post_id = post_insert.data[0]['id']
-                
-                # Insert engagement metrics
-                supabase.table('engagement_metrics').upsert({
-                    'post_id': db_post_id,
-                    'likes': likes,
-                    'comments': comments,
-                    'shares': shares,
-                    'impressions': impressions,
-                    'clicks': int(post.get('clicks') or post.get('Clicks') or 0),
-                    'engagement_rate': calculate_engagement_rate({
-                        'likes': likes, 'comments': comments, 'shares': shares, 'impressions': impressions
-                    }),
-                    'measured_at': datetime.utcnow().isoformat()
-                }).execute()
-                
-                print(f"✓ Saved CSV post {i}: {content[:50]}...")
-                processed_count += 1
+                'mentions': mentions
+            }
+            if STORE_RAW:
+                record['raw_data'] = {name: value.strip() for name, value in zip(header, row)}
+            post_rows[post_id] = record
+            metric_rows[post_id] = {
+                'likes': likes,
+                'comments': comments,
+                'shares': shares,
+                'impressions': impressions,
+                'clicks': int(row[columns['clicks']].strip() or 0),
+                'measured_at': measured_at
+            }
                 
         except Exception as post_error:
-            print(f"✗ Error processing CSV post {i}: {post_error}")
+            logger.warning("✗ Error processing CSV post %d: %s", i, post_error)
             continue
+
+        if len(post_rows) >= batch_size:
+            # Keep at most SUPABASE_CONCURRENCY batches in flight so the
+            # download keeps streaming while earlier batches are written,
+            # without buffering the rest of the file behind them
+            if len(pending) >= SUPABASE_CONCURRENCY:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                processed_count += sum(future.result() for future in done)
+            pending.update(submit_post_batches(list(post_rows.values()), metric_rows))
+            post_rows, metric_rows = {}, {}
+
+    if post_rows:
+        pending.update(submit_post_batches(list(post_rows.values()), metric_rows))
+    processed_count += sum(future.result() for future in pending)
     
+    return processed_count, row_count
+
+def company_fingerprint(row):
+    """Hash a company_profile row's content, ignoring when it was fetched"""
+    return hash(orjson.dumps({k: v for k, v in row.items() if k != 'fetched_at'}, option=orjson.OPT_SORT_KEYS))
+
+def upsert_company_profiles(rows, fingerprints):
+    """Upsert company_profile rows and remember their fingerprints, returning how many were written"""
+    execute_with_retry(lambda db: get_table(db, 'company_profile').upsert(
+        rows, on_conflict='name', returning='minimal'
+    ))
+    with company_fingerprints_lock:
+        for row in rows:
+            company_fingerprints[row['name']] = fingerprints[row['name']]
+            company_fingerprints.move_to_end(row['name'])
+        while len(company_fingerprints) > COMPANY_CACHE_SIZE:
+            company_fingerprints.popitem(last=False)
+    return len(rows)
+
+def save_company_profiles(companies):
+    """Bulk upsert company_profile rows that changed since this process last saved them, returning how many were handled"""
+    fingerprints = {row['name']: company_fingerprint(row) for row in companies}
+    with company_fingerprints_lock:
+        changed = [row for row in companies if company_fingerprints.get(row['name']) != fingerprints[row['name']]]
+    unchanged = len(companies) - len(changed)
+    if not changed:
+        logger.info("✓ %d Company Profiles unchanged", len(companies))
+        return len(companies)
+
+    try:
+        saved = write_valid_rows(upsert_company_profiles, changed, 'name', fingerprints)
+        logger.info("✓ %d Company Profiles Saved (%d unchanged)", saved, unchanged)
+        return saved + unchanged
+    except Exception as company_error:
+        logger.error("✗ Error saving company profiles: %s", company_error)
+        return 0
+
+def upsert_posts_with_metrics(posts, metric_rows):
+    """Bulk upsert posts, then upsert the engagement_metrics row of each returned post, returning how many were saved"""
+    post_resp = execute_with_retry(lambda db: get_table(db, 'posts').upsert(
+        posts, on_conflict='linkedin_post_id', returning='representation'
+    ))
+
+    # Match returned ids back by linkedin_post_id rather than relying on row order
+    metrics = []
+    for row in post_resp.data or []:
+        metric_row = metric_rows.get(row.get('linkedin_post_id'))
+        if metric_row is not None:
+            metrics.append(dict(metric_row, post_id=row['id']))
+
+    if not metrics:
+        logger.warning("⚠ Warning: No data returned from post insert")
+        return 0
+
+    # measured_at is stamped per processed delivery, so this only absorbs a
+    # retried write of the same batch; redeliveries are new measurements
+    execute_with_retry(lambda db: get_table(db, 'engagement_metrics').upsert(
+        metrics, on_conflict='post_id,measured_at', ignore_duplicates=True, returning='minimal'
+    ))
+    logger.info("✓ Post and Engagement Data Saved for %d posts", len(metrics))
+    return len(metrics)
+
+def save_posts_with_metrics(posts, metric_rows):
+    """Bulk upsert posts and their engagement_metrics rows, returning how many were saved
+
+    metric_rows maps linkedin_post_id to that post's metrics row, minus post_id.
+    """
+    try:
+        return write_valid_rows(upsert_posts_with_metrics, posts, 'linkedin_post_id', metric_rows)
+    except Exception as post_error:
+        logger.error("✗ Error saving posts: %s", post_error)
+        return 0
+
+def call_ingest_posts(posts, metric_rows):
+    """Write posts and their engagement_metrics rows in one ingest_posts RPC, returning how many were saved"""
+    payload = [dict(metric_rows[post['linkedin_post_id']], **post) for post in posts]
+    response = execute_with_retry(lambda db: db.rpc('ingest_posts', {'payload': payload}))
+    # ingest_posts returns a single row holding the count
+    saved = response.data[0]['saved']
+    logger.info("✓ Post and Engagement Data Saved for %d posts", saved)
+    return saved
+
+def ingest_posts_with_metrics(posts, metric_rows):
+    """Write posts and their engagement_metrics rows through ingest_posts, returning how many were saved"""
+    try:
+        return write_valid_rows(call_ingest_posts, posts, 'linkedin_post_id', metric_rows)
+    except Exception as post_error:
+        logger.error("✗ Error saving posts: %s", post_error)
+        return 0
+
+def copy_into_temp_table(cur, table, rows):
+    """COPY rows (dicts sharing one key set) into a temp clone of table, returning (temp_name, columns)"""
+    temp = f'tmp_{table}'
+    columns = list(rows[0])
+    names = sql.SQL(', ').join(map(sql.Identifier, columns))
+    # Only the columns being written, with their types but none of the
+    # table's constraints (the real insert below enforces those)
+    cur.execute(sql.SQL('CREATE TEMP TABLE {} ON COMMIT DROP AS SELECT {} FROM {} WITH NO DATA').format(
+        sql.Identifier(temp), names, sql.Identifier(table)
+    ))
+
+    # Dump each value as its column's real type so lists and dicts land in
+    # array/jsonb columns as they would through PostgREST
+    cur.execute(sql.SQL('SELECT {} FROM {} LIMIT 0').format(names, sql.Identifier(temp)))
+    types = [column.type_code for column in cur.description]
+    with cur.copy(sql.SQL('COPY {} ({}) FROM STDIN').format(sql.Identifier(temp), names)) as copy:
+        copy.set_types(types)
+        for row in rows:
+            copy.write_row([row[column] for column in columns])
+
+    return temp, columns
+
+def get_copy_connection():
+    """Return this thread's direct Postgres connection for COPY, reconnecting if it was lost"""
+    conn = getattr(copy_connections, 'conn', None)
+    if conn is None or conn.closed or conn.broken:
+        # prepare_threshold=None: the Supavisor transaction pooler may run each
+        # transaction on a different server connection, so nothing is prepared
+        conn = psycopg.connect(SUPABASE_DB_URL, autocommit=True, prepare_threshold=None)
+        copy_connections.conn = conn
+    return conn
+
+def copy_posts_with_metrics(posts, metric_rows):
+    """Write posts and their engagement_metrics rows with COPY over SUPABASE_DB_URL, returning how many were saved
+
+    Same upsert semantics as save_posts_with_metrics, in a single transaction;
+    falls back to PostgREST batches if the direct connection fails.
+    """
+    try:
+        conn = get_copy_connection()
+        with conn.transaction(), conn.cursor() as cur:
+            temp, columns = copy_into_temp_table(cur, 'posts', posts)
+            names = sql.SQL(', ').join(map(sql.Identifier, columns))
+            updates = sql.SQL(', ').join(
+                sql.SQL('{0} = EXCLUDED.{0}').format(sql.Identifier(column))
+                for column in columns if column != 'linkedin_post_id'
+            )
+            cur.execute(sql.SQL(
+                'INSERT INTO posts ({names}) SELECT {names} FROM {temp} '
+                'ON CONFLICT (linkedin_post_id) DO UPDATE SET {updates} '
+                'RETURNING id, linkedin_post_id'
+            ).format(names=names, temp=sql.Identifier(temp), updates=updates))
+
+            metrics = []
+            for post_id, linkedin_post_id in cur.fetchall():
+                metric_row = metric_rows.get(linkedin_post_id)
+                if metric_row is not None:
+                    metrics.append(dict(metric_row, post_id=post_id))
+            if not metrics:
+                logger.warning("⚠ Warning: No data returned from post COPY")
+                return 0
+
+            temp, columns = copy_into_temp_table(cur, 'engagement_metrics', metrics)
+            names = sql.SQL(', ').join(map(sql.Identifier, columns))
+            cur.execute(sql.SQL(
+                'INSERT INTO engagement_metrics ({names}) SELECT {names} FROM {temp} '
+                'ON CONFLICT (post_id, measured_at) DO NOTHING'
+            ).format(names=names, temp=sql.Identifier(temp)))
+
+        logger.info("✓ Post and Engagement Data COPYed for %d posts", len(metrics))
+        return len(metrics)
+    except Exception as copy_error:
+        logger.error("✗ Error copying posts, falling back to PostgREST: %s", copy_error)
+        return sum(
+            save_posts_with_metrics(posts[start:start + SUPABASE_BATCH_SIZE], metric_rows)
+            for start in range(0, len(posts), SUPABASE_BATCH_SIZE)
+        )
+
+def submit_post_batches(posts, metric_rows):
+    """Queue posts and their metrics rows for writing on db_executor, returning the futures
+
+    A batch of COPY_THRESHOLD or more posts is COPYed when COPY_ENABLED;
+    anything else goes to PostgREST in SUPABASE_BATCH_SIZE slices, through
+    ingest_posts when SUPABASE_INGEST_RPC is set.
+    """
+    if COPY_ENABLED and len(posts) >= COPY_THRESHOLD:
+        return [db_executor.submit(copy_posts_with_metrics, posts, metric_rows)]
+    save = ingest_posts_with_metrics if SUPABASE_INGEST_RPC else save_posts_with_metrics
+    return [
+        db_executor.submit(save, posts[start:start + SUPABASE_BATCH_SIZE], metric_rows)
+        for start in range(0, len(posts), SUPABASE_BATCH_SIZE)
+    ]
+
+# Types a resultObject companyName/postId may have to be saved
+ITEM_ID_TYPES = (str, int)
+
+# resultObject field mappings as (column, item key, default). Defaults are
+# shared between rows, so they must be immutable (tuples, not lists).
+COMPANY_FIELDS = (
+    ('name', 'companyName', None),
+    ('linkedin_url', 'companyUrl', ''),
+    ('followers', 'followerCount', 0),
+    ('website', 'website', ''),
+    ('description', 'description', ''),
+    ('industry', 'industry', ''),
+    ('company_size', 'companySize', ''),
+    ('location', 'location', ''),
+)
+POST_FIELDS = (
+    ('linkedin_post_id', 'postId', None),
+    ('content', 'content', ''),
+    ('post_type', 'postType', ''),
+    ('published_at', 'publishedAt', ''),
+    ('author_id', 'authorId', ''),
+    ('hashtags', 'hashtags', ()),
+    ('mentions', 'mentions', ()),
+)
+METRIC_FIELDS = (
+    ('likes', 'likes', 0),
+    ('comments', 'comments', 0),
+    ('shares', 'shares', 0),
+    ('impressions', 'impressions', 0),
+    ('clicks', 'clicks', 0),
+)
+
+def project(item, fields, _get=dict.get):
+    """Build a row from item using a (column, item key, default) field table"""
+    # _get is bound as a default so each field lookup is a local (LOAD_FAST)
+    # call instead of a per-item method lookup
+    return {column: _get(item, key, default) for column, key, default in fields}
+
+def company_row(item, now_iso):
+    """Map a resultObject company item to a company_profile row"""
+    row = project(item, COMPANY_FIELDS)
+    row['specialties'] = []
+    row['fetched_at'] = now_iso
+    return row
+
+def post_row(item, now_iso):
+    """Map a resultObject post item to a posts row"""
+    row = project(item, POST_FIELDS)
+    if STORE_RAW:
+        row['raw_data'] = item
+    return row
+
+def metrics_row(item, measured_at):
+    """Map a resultObject post item to its engagement_metrics row, minus post_id
+
+    engagement_rate is a generated column, so it's never sent.
+    """
+    row = project(item, METRIC_FIELDS)
+    row['measured_at'] = measured_at
+    return row
+
+def process_json_items(result_data):
+    """Save resultObject items to Supabase in bulk, returning (processed_count, item_count)
+
+    item_count is how many distinct companies and posts were found, so a
+    processed_count short of it means some rows were not written.
+    """
+    # Partition items by type up front so each table gets a single round-trip;
+    # an item carrying both fields is a company. Items are keyed by their
+    # conflict column: PostgREST rejects a bulk upsert that touches the same
+    # row twice, so the last occurrence wins.
+    # Only string or integer ids can be keys (and conflict values); an item
+    # whose id is a list, object or null is skipped on its own rather than
+    # failing the whole partition and every delivery merged into it.
+    items = [item for item in result_data if isinstance(item, dict)]
+    company_items = {item['companyName']: item for item in items
+                     if isinstance(item.get('companyName'), ITEM_ID_TYPES)}
+    post_items = {item['postId']: item for item in items
+                  if 'companyName' not in item and isinstance(item.get('postId'), ITEM_ID_TYPES)}
+    malformed = sum(1 for item in items
+                    if not isinstance(item.get('companyName', item.get('postId', '')), ITEM_ID_TYPES))
+    if malformed:
+        logger.warning("⚠ Skipping %d items whose companyName/postId is not a string or integer", malformed)
+    if logger.isEnabledFor(logging.DEBUG):
+        known = sum(1 for item in items if 'companyName' in item or 'postId' in item)
+        logger.debug("✓ %d companies, %d posts, %d unknown items",
+                     len(company_items), len(post_items), len(result_data) - known)
+
+    # One timestamp for the whole batch instead of one per row
+    now_iso = datetime.now(timezone.utc).isoformat()
+    companies = [company_row(item, now_iso) for item in company_items.values()]
+    posts = [post_row(item, now_iso) for item in post_items.values()]
+    metric_rows = {post_id: metrics_row(item, now_iso) for post_id, item in post_items.items()}
+
+    # Company rows and each posts batch are independent of one another, so
+    # they all go out side by side on the shared pool
+    futures = [db_executor.submit(save_company_profiles, companies)] if companies else []
+    futures.extend(submit_post_batches(posts, metric_rows))
+
+    return sum(future.result() for future in futures), len(companies) + len(posts)
+
+def process_csv_url(csv_url):
+    """Stream, parse and save the CSV behind a PhantomBuster result URL, returning how many posts were saved"""
+    try:
+        processed_count, row_count = process_csv_posts(iter_csv_rows(csv_url))
+    except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError, OSError) as e:
+        # Errors while reading the streamed body come straight from urllib3
+        # or the socket; requests only wraps those raised by the request itself
+        logger.error("✗ Error downloading CSV: %s", e)
+        return 0
+
+    if not row_count:
+        logger.warning("✗ No valid posts found in CSV")
+        return 0
+
+    logger.info("✓ CSV Webhook completed: %d/%d posts processed", processed_count, row_count)
     return processed_count
 
+def webhook_dedupe_cutoff():
+    """ISO timestamp before which a processed webhook delivery no longer counts as seen"""
+    return datetime.fromtimestamp(time.time() - WEBHOOK_DEDUPE_WINDOW, timezone.utc).isoformat()
+
+def webhook_event_seen(event_id):
+    """Whether a webhook delivery with this id was processed within WEBHOOK_DEDUPE_WINDOW (False if it can't be checked)"""
+    try:
+        cutoff = webhook_dedupe_cutoff()
+        response = execute_with_retry(lambda db: get_table(db, 'webhook_events').select('event_id')
+                                      .eq('event_id', event_id).gte('processed_at', cutoff).limit(1))
+        return bool(response.data)
+    except Exception as e:
+        # Without the webhook_events table every delivery is processed; the
+        # upserts are idempotent, the dedupe only saves the repeated work
+        logger.warning("⚠ Could not check webhook event %s: %s", event_id, e)
+        return False
+
+def record_webhook_event(event_id, job_format):
+    """Remember a processed webhook delivery so redeliveries of it are skipped"""
+    try:
+        execute_with_retry(lambda db: get_table(db, 'webhook_events').upsert(
+            {'event_id': event_id, 'format': job_format, 'processed_at': datetime.now(timezone.utc).isoformat()},
+            on_conflict='event_id', returning='minimal'
+        ))
+    except Exception as e:
+        logger.warning("⚠ Could not record webhook event %s: %s", event_id, e)
+
+def prune_webhook_events():
+    """Delete webhook_events rows older than WEBHOOK_DEDUPE_WINDOW, at most once per window"""
+    global webhook_events_pruned_at
+    if webhook_events_pruned_at is not None and time.monotonic() - webhook_events_pruned_at < WEBHOOK_DEDUPE_WINDOW:
+        return
+    webhook_events_pruned_at = time.monotonic()
+    try:
+        cutoff = webhook_dedupe_cutoff()
+        execute_with_retry(lambda db: get_table(db, 'webhook_events').delete(returning='minimal')
+                           .lt('processed_at', cutoff))
+        logger.debug("Pruned webhook events processed before %s", cutoff)
+    except Exception as e:
+        logger.warning("⚠ Could not prune webhook events: %s", e)
+
+def take_webhook_jobs():
+    """Block for the next queued job, then gather JSON jobs arriving just behind it
+
+    Up to WEBHOOK_COALESCE_WINDOW seconds are spent collecting further JSON
+    deliveries until SUPABASE_BATCH_SIZE items are pending, so a burst of
+    small webhooks becomes one set of bulk upserts. A CSV job ends the batch.
+    """
+    jobs = [webhook_queue.get()]
+    if jobs[0][0] != 'JSON':
+        return jobs
+
+    pending_items = len(jobs[0][1])
+    deadline = time.monotonic() + WEBHOOK_COALESCE_WINDOW
+    while pending_items < SUPABASE_BATCH_SIZE:
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+            break
+        try:
+            job = webhook_queue.get(timeout=timeout)
+        except queue.Empty:
+            break
+        jobs.append(job)
+        if job[0] != 'JSON':
+            break
+        pending_items += len(job[1])
+    return jobs
+
+def run_webhook_worker():
+    """Drain queued webhook payloads and write them to Supabase"""
+    while True:
+        jobs = take_webhook_jobs()
+        try:
+            fresh = []
+            for job_format, payload, event_id in jobs:
+                if job_format == 'JSON' and webhook_event_seen(event_id):
+                    logger.info("↩ Skipping redelivered %s webhook %s", job_format, event_id)
+                else:
+                    fresh.append((job_format, payload, event_id))
+
+            json_jobs = [job for job in fresh if job[0] == 'JSON']
+            if json_jobs:
+                started = time.perf_counter()
+                items = [item for _, payload, _ in json_jobs for item in payload]
+                processed_items, item_count = process_json_items(items)
+                logger.info("✓ JSON Webhook completed: %d/%d items from %d webhooks processed in %.2fs",
+                            processed_items, item_count, len(json_jobs), time.perf_counter() - started)
+                # Merged deliveries can't be told apart once written, so they are
+                # only remembered if every row landed; after any rejected or failed
+                # write, a redelivery of each of them is processed again
+                if processed_items == item_count:
+                    for job_format, _, event_id in json_jobs:
+                        record_webhook_event(event_id, job_format)
+
+            for job_format, csv_url, _ in fresh:
+                if job_format == 'CSV':
+                    process_csv_url(csv_url)
+        except Exception as e:
+            logger.exception("✗ Webhook worker error: %s", e)
+        finally:
+            for _ in jobs:
+                webhook_queue.task_done()
+        prune_webhook_events()
+
+def enqueue_webhook_job(job_format, payload, event_id):
+    """Queue a webhook payload for the background worker; False if the queue is full"""
+    global webhook_worker
+
+    # Start the worker lazily so each gunicorn worker process gets its own thread
+    # (threads started before a fork don't survive it)
+    if webhook_worker is None or not webhook_worker.is_alive():
+        with webhook_worker_lock:
+            if webhook_worker is None or not webhook_worker.is_alive():
+                webhook_worker = threading.Thread(target=run_webhook_worker, name='webhook-worker', daemon=True)
+                webhook_worker.start()
+
+    try:
+        webhook_queue.put_nowait((job_format, payload, event_id))
+        return True
+    except queue.Full:
+        logger.warning("✗ Webhook queue full (%d jobs pending)", webhook_queue.maxsize)
+        return False
+
+@app.before_request
+def check_webhook_body():
+    """Reject webhook bodies that are too large, unsigned or not declared JSON before parsing them"""
+    if request.endpoint != 'webhook':
+        return None
+
+    if not request.is_json:
+        logger.warning("✗ Rejected webhook with Content-Type: %s", request.content_type)
+        return jsonify({'status': 'error', 'message': 'Content-Type must be application/json'}), 415
+
+    # Chunked bodies have no length to check up front
+    if request.content_length is None:
+        logger.warning("✗ Rejected webhook without Content-Length")
+        return jsonify({'status': 'error', 'message': 'Content-Length header is required'}), 411
+
+    if request.content_length > app.config['MAX_CONTENT_LENGTH']:
+        logger.warning("✗ Rejected webhook of %d bytes", request.content_length)
+        return jsonify({'status': 'error', 'message': 'Payload too large'}), 413
+
+    # An unsigned request can be refused without reading its body at all
+    if WEBHOOK_SECRET and not request.headers.get('X-Signature'):
+        logger.warning("✗ Rejected unsigned webhook")
+        return jsonify({'status': 'error', 'message': 'Missing signature'}), 401
+
+    return None
+
+def webhook_signature_valid(body):
+    """Whether the request's X-Signature is the HMAC-SHA256 of body under WEBHOOK_SECRET"""
+    expected = hmac.new(WEBHOOK_SECRET.encode(), body, hashlib.sha256).hexdigest()
+    # Compared as bytes: compare_digest refuses non-ASCII str, and Werkzeug
+    # decodes headers as latin-1, so any sender could otherwise raise here.
+    # Hex digests are case-insensitive
+    signature = request.headers.get('X-Signature', '').strip().lower()
+    return hmac.compare_digest(expected.encode(), signature.encode('latin-1', 'replace'))
+
 @app.route('/')
 def root():
     return jsonify({
         'message': 'PhantomBuster Webhook Server - JSON & CSV Support!', 
         'status': 'ok',
-        'supabase_status': 'connected' if supabase else 'disconnected',
+        'supabase_status': 'connected' if get_supabase() else 'disconnected',
         'supported_formats': ['JSON with resultObject', 'CSV download URL'],
         'phantom_credentials': 'configured' if PHANTOMBUSTER_API_KEY and PHANTOM_AGENT_ID else 'missing',
         'available_endpoints': [
@@ -186,43 +964,39 @@ def root():
             'POST /fetch-phantom-result',
             'POST /webhook'
         ],
-        'timestamp': datetime.utcnow().isoformat()
+        'timestamp': datetime.now(timezone.utc).isoformat()
     }), 200
 
 @app.route('/health')
 def health():
     return jsonify({
         'status': 'ok', 
-        'supabase': 'ok' if supabase else 'error',
+        'supabase': 'ok' if get_supabase() else 'error',
         'phantom_api': 'ok' if PHANTOMBUSTER_API_KEY else 'missing',
         'phantom_agent': 'ok' if PHANTOM_AGENT_ID else 'missing',
-        'timestamp': datetime.utcnow().isoformat()
+        'timestamp': datetime.now(timezone.utc).isoformat()
     }), 200
 
 @app.route('/trigger-phantom', methods=['POST'])
 def trigger_phantom():
     try:
-        print("=== TRIGGER PHANTOM CALLED ===")
+        logger.info("=== TRIGGER PHANTOM CALLED ===")
         
-        api_key = os.getenv('PHANTOMBUSTER_API_KEY')
-        agent_id = os.getenv('PHANTOM_AGENT_ID')
-        
-        if not api_key or not agent_id:
-            print("✗ Phantom API credentials missing")
+        if not PHANTOMBUSTER_API_KEY or not PHANTOM_AGENT_ID:
+            logger.error("✗ Phantom API credentials missing")
             return jsonify({'status': 'error', 'message': 'Phantom API credentials missing'}), 500
         
-        print(f"✓ Using Agent ID: {agent_id}")
+        logger.info("✓ Using Agent ID: %s", PHANTOM_AGENT_ID)
         
         # Get any custom arguments from request body (optional)
         request_data = request.json or {}
         custom_args = request_data.get('arguments', {})
 
         # Inject LinkedIn Session Cookie from ENV
-        linkedin_cookie = os.getenv('LINKEDIN_SESSION_COOKIE')
-        if linkedin_cookie:
-            custom_args['sessionCookie'] = linkedin_cookie
+        if LINKEDIN_SESSION_COOKIE:
+            custom_args['sessionCookie'] = LINKEDIN_SESSION_COOKIE
         else:
-            print("✗ LINKEDIN_SESSION_COOKIE not found in environment variables")
+            logger.error("✗ LINKEDIN_SESSION_COOKIE not found in environment variables")
             return jsonify({'status': 'error', 'message': 'Missing LinkedIn sessionCookie in env'}), 500
 
         # Add required Phantom arguments (override if already present)
@@ -236,7 +1010,7 @@ def trigger_phantom():
         custom_args['userAgent'] = "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:141.0) Gecko/20100101 Firefox/141.0"
 
         payload = {
-            'id': agent_id,  # Phantom Agent ID
+            'id': PHANTOM_AGENT_ID,  # Phantom Agent ID
             'argument': custom_args,  # Complete argument payload
             'saveArgument': False
         }
@@ -244,16 +1018,17 @@ def trigger_phantom():
         launch_url = 'https://api.phantombuster.com/api/v2/agents/launch'
         headers = {
             'Content-Type': 'application/json',
-            'X-Phantombuster-Key-1': api_key
+            'X-Phantombuster-Key-1': PHANTOMBUSTER_API_KEY
         }
 
-        print(f"📤 Sending launch request to: {launch_url}")
-        print(f"📋 Payload: {json.dumps(payload, indent=2)}")
+        logger.info("📤 Sending launch request to: %s", launch_url)
+        # Only the argument names: the payload carries the LinkedIn session cookie
+        logger.debug("📋 Launch arguments: %s", sorted(custom_args))
 
-        response = requests.post(launch_url, headers=headers, json=payload, timeout=30)
+        response = http_session.post(launch_url, headers=headers, data=orjson.dumps(payload), timeout=30)
         
         if response.status_code != 200:
-            print(f"✗ Phantom API Error: {response.status_code} {response.text}")
+            logger.error("✗ Phantom API Error: %s %s", response.status_code, response.text)
             return jsonify({
                 'status': 'error', 
                 'message': 'Failed to trigger Phantom', 
@@ -261,8 +1036,8 @@ def trigger_phantom():
                 'status_code': response.status_code
             }), 500
         
-        launch_data = response.json()
-        print(f"✓ Phantom triggered successfully: {launch_data}")
+        launch_data = orjson.loads(response.content)
+        logger.info("✓ Phantom triggered successfully: %s", launch_data)
         
         return jsonify({
             'status': 'success', 
@@ -271,7 +1046,7 @@ def trigger_phantom():
         }), 200
     
     except Exception as e:
-        print(f"✗ Error triggering Phantom: {e}")
+        logger.error("✗ Error triggering Phantom: %s", e)
         return jsonify({'status': 'error', 'message': 'Internal server error', 'details': str(e)}), 500
 
 
@@ -280,11 +1055,10 @@ def trigger_phantom():
 @app.route('/run-phantom', methods=['POST'])
 def run_phantom():
     try:
-        print("=== RUNNING PHANTOM ===")
+        logger.info("=== RUNNING PHANTOM ===")
         
         # PhantomBuster API Config
-        PHANTOMBUSTER_API_KEY = os.getenv('PHANTOMBUSTER_API_KEY')
-        PHANTOM_AGENT_ID = '7741390690252670'  # <-- This is your Phantom Agent ID
+        agent_id = '7741390690252670'  # <-- This is your Phantom Agent ID
         
         if not PHANTOMBUSTER_API_KEY:
             return jsonify({'status': 'error', 'message': 'Missing PhantomBuster API Key'}), 500
@@ -298,17 +1072,17 @@ def run_phantom():
         }
         
         payload = {
-            'id': PHANTOM_AGENT_ID,
+            'id': agent_id,
             'save': True
         }
         
-        print("📡 Launching Phantom via API Call...")
-        response = requests.post(api_url, headers=headers, json=payload)
+        logger.info("📡 Launching Phantom via API Call...")
+        response = http_session.post(api_url, headers=headers, data=orjson.dumps(payload))
         response.raise_for_status()
         
-        run_result = response.json()
-        print("✓ Phantom run triggered successfully!")
-        print(json.dumps(run_result, indent=2))
+        run_result = orjson.loads(response.content)
+        logger.info("✓ Phantom run triggered successfully!")
+        logger.debug("Phantom run result: %s", run_result)
         
         return jsonify({
             'status': 'success',
@@ -317,27 +1091,25 @@ def run_phantom():
         }), 200
     
     except Exception as e:
-        print(f"✗ Error running Phantom: {e}")
+        logger.error("✗ Error running Phantom: %s", e)
         return jsonify({'status': 'error', 'message': 'Failed to run Phantom', 'error': str(e)}), 500
 
 @app.route('/fetch-phantom-result', methods=['POST'])
 def fetch_phantom_result():
     try:
-        print("=== FETCHING PHANTOM RESULT VIA AGENT OUTPUT ===")
-        api_key = os.getenv('PHANTOMBUSTER_API_KEY')
-        agent_id = os.getenv('PHANTOM_AGENT_ID')
-        if not api_key or not agent_id:
+        logger.info("=== FETCHING PHANTOM RESULT VIA AGENT OUTPUT ===")
+        if not PHANTOMBUSTER_API_KEY or not PHANTOM_AGENT_ID:
             return jsonify({'status': 'error', 'message': 'Missing Phantom API Key or Agent ID'}), 500
 
         url = f"https://api.phantombuster.com/api/v2/agents/fetch-output"
-        headers = {'X-Phantombuster-Key-1': api_key}
-        params = {'id': agent_id}
+        headers = {'X-Phantombuster-Key-1': PHANTOMBUSTER_API_KEY}
+        params = {'id': PHANTOM_AGENT_ID}
 
-        response = requests.get(url, headers=headers, params=params, timeout=30)
+        response = http_session.get(url, headers=headers, params=params, timeout=30)
         response.raise_for_status()
-        data = response.json()
+        data = orjson.loads(response.content)
 
-        print("✓ Agent output fetched:", data)
+        logger.debug("✓ Agent output fetched: %s", data)
         csv_url = data.get('csvUrl') or data.get('resultUrl')
         result_object = data.get('resultObject')
 
@@ -350,10 +1122,10 @@ def fetch_phantom_result():
         }), 200
 
     except requests.exceptions.RequestException as e:
-        print("✗ Fetch error:", e)
+        logger.error("✗ Fetch error: %s", e)
         return jsonify({'status': 'error', 'message': 'Failed to fetch output', 'error': str(e)}), 500
     except Exception as e:
-        print("✗ Unexpected error:", e)
+        logger.exception("✗ Unexpected error: %s", e)
         return jsonify({'status': 'error', 'message': 'Internal server error', 'error': str(e)}), 500
 
 
@@ -361,9 +1133,7 @@ def fetch_phantom_result():
 @app.route('/get-phantom-status', methods=['POST'])
 def get_phantom_status():
     try:
-        print("=== CHECKING PHANTOM STATUS ===")
-        
-        PHANTOMBUSTER_API_KEY = os.getenv('PHANTOMBUSTER_API_KEY')
+        logger.info("=== CHECKING PHANTOM STATUS ===")
         
         if not PHANTOMBUSTER_API_KEY:
             return jsonify({'status': 'error', 'message': 'Missing PhantomBuster API Key'}), 500
@@ -378,7 +1148,7 @@ def get_phantom_status():
                 'message': 'Container ID is required. Pass it as {"container_id": "your-container-id"}'
             }), 400
         
-        print(f"🔍 Checking status for container: {container_id}")
+        logger.info("🔍 Checking status for container: %s", container_id)
         
         # API Endpoint to get container status
         api_url = f'https://api.phantombuster.com/api/v2/containers/fetch'
@@ -392,14 +1162,14 @@ def get_phantom_status():
             'id': container_id
         }
         
-        response = requests.post(api_url, headers=headers, json=payload, timeout=30)
+        response = http_session.post(api_url, headers=headers, data=orjson.dumps(payload), timeout=30)
         response.raise_for_status()
         
-        status_data = response.json()
+        status_data = orjson.loads(response.content)
         
         if 'data' in status_data:
             container_status = status_data['data'].get('status', 'unknown')
-            print(f"✓ Container Status: {container_status}")
+            logger.info("✓ Container Status: %s", container_status)
             
             return jsonify({
                 'status': 'success',
@@ -418,7 +1188,7 @@ def get_phantom_status():
             }), 500
     
     except Exception as e:
-        print(f"✗ Error checking status: {e}")
+        logger.error("✗ Error checking status: %s", e)
         return jsonify({
             'status': 'error', 
             'message': 'Failed to check container status', 
@@ -428,137 +1198,90 @@ def get_phantom_status():
 @app.route('/webhook', methods=['POST'])
 def webhook():
     try:
-        print("=== WEBHOOK CALLED ===")
+        logger.info("=== WEBHOOK CALLED ===")
         
         # Check if Supabase is available
-        if not supabase:
-            print("✗ Supabase not available")
+        if not get_supabase():
+            logger.error("✗ Supabase not available")
             return jsonify({'status': 'error', 'message': 'Database connection not available'}), 500
         
-        data = request.json
-        if not data:
-            print("✗ No JSON data received")
+        # Read the body uncached so the raw bytes can be freed once decoded,
+        # instead of living on the request next to the parsed payload
+        body = request.get_data(cache=False)
+        # Verify before parsing so a forged body costs one hash, not a decode
+        if WEBHOOK_SECRET and not webhook_signature_valid(body):
+            logger.warning("✗ Rejected webhook with invalid signature")
+            return jsonify({'status': 'error', 'message': 'Invalid signature'}), 401
+        # PhantomBuster redelivers the identical body on retry, so its digest
+        # identifies a resultObject delivery for the worker's dedupe check
+        event_id = hashlib.blake2b(body, digest_size=16).hexdigest()
+        try:
+            data = orjson.loads(body) if body else None
+        except ValueError as e:
+            logger.warning("✗ Invalid JSON body: %s", e)
+            return jsonify({'status': 'error', 'message': 'Invalid JSON body'}), 400
+        del body
+
+        if not data or not isinstance(data, dict):
+            logger.warning("✗ No JSON data received")
             return jsonify({'status': 'error', 'message': 'No JSON data received'}), 400
         
-        print("✓ Incoming Data received:", list(data.keys()))
+        logger.info("✓ Incoming Data received: %s", list(data.keys()))
         
         # Check if this is a CSV-based webhook (new format)
         csv_url = data.get('csvUrl') or data.get('csv_url') or data.get('downloadUrl') or data.get('resultUrl')
         
         if csv_url:
-            print("🔄 Processing CSV-based webhook...")
-            
-            # Download CSV content
-            csv_content = download_csv_from_url(csv_url)
-            if not csv_content:
-                return jsonify({'status': 'error', 'message': 'Failed to download CSV'}), 400
-            
-            # Parse CSV and extract posts
-            posts_data = parse_csv_content(csv_content)
-            if not posts_data:
-                return jsonify({'status': 'error', 'message': 'No valid posts found in CSV'}), 400
-            
-            # Process CSV posts
-            processed_count = process_csv_posts(posts_data)
-            
-            print(f"✓ CSV Webhook completed: {processed_count}/{len(posts_data)} posts processed")
-            
+            logger.info("🔄 Queueing CSV-based webhook...")
+            # No event id: the URL is the same for every run, so it can't tell
+            # a retry from a new result
+            if not enqueue_webhook_job('CSV', csv_url, None):
+                return jsonify({'status': 'error', 'message': 'Webhook queue is full, retry later'}), 503
+
             return jsonify({
-                'status': 'success',
-                'message': f'CSV processed: {processed_count} out of {len(posts_data)} posts saved',
-                'processed_count': processed_count,
-                'total_count': len(posts_data),
+                'status': 'queued',
+                'message': 'CSV queued for processing',
                 'format': 'CSV'
-            }), 200
+            }), 202
         
         # Check if this is the original JSON format
         elif 'resultObject' in data:
-            print("🔄 Processing JSON-based webhook (original format)...")
+            logger.info("🔄 Processing JSON-based webhook (original format)...")
             
-            # Parse the resultObject string into JSON
+            # Parse the resultObject string into JSON; senders that post it as a
+            # real array skip the second decode. Popping it drops the payload's
+            # reference so the string is freed as soon as it's parsed
             try:
-                result_data = json.loads(data['resultObject'])
-                print("✓ Parsed Result Data:", len(result_data), "items")
-            except json.JSONDecodeError as e:
-                print(f"✗ JSON parsing error: {e}")
+                result_data = data.pop('resultObject')
+                if isinstance(result_data, (str, bytes)):
+                    result_data = orjson.loads(result_data)
+            except orjson.JSONDecodeError as e:
+                logger.warning("✗ JSON parsing error: %s", e)
                 return jsonify({'status': 'error', 'message': f'Invalid JSON in resultObject: {str(e)}'}), 400
             
             if not isinstance(result_data, list):
-                print("✗ resultObject is not a list")
+                logger.warning("✗ resultObject is not a list")
                 return jsonify({'status': 'error', 'message': 'resultObject should contain a list'}), 400
+            logger.info("✓ Parsed Result Data: %d items", len(result_data))
+
+            # Nothing to write, so don't spend a queue slot or a dedupe lookup on it
+            if not result_data:
+                logger.info("✓ JSON Webhook empty, nothing to process")
+                return '', 204
             
-            processed_items = 0
-            
-            for i, item in enumerate(result_data):
-                try:
-                    print(f"Processing item {i+1}/{len(result_data)}")
-                    
-                    # Check if it's a Company Profile Data
-                    if 'companyName' in item:
-                        print(f"✓ Processing company: {item['companyName']}")
-                        supabase.table('company_profile').upsert({
-                            'name': item['companyName'],
-                            'linkedin_url': item.get('companyUrl', ''),
-                            'followers': item.get('followerCount', 0),
-                            'website': item.get('website', ''),
-                            'description': item.get('description', ''),
-                            'industry': item.get('industry', ''),
-                            'company_size': item.get('companySize', ''),
-                            'specialties': [],
-                            'location': item.get('location', ''),
-                            'fetched_at': datetime.utcnow().isoformat()
-                        }).execute()
-                        print("✓ Company Profile Saved")
-                        processed_items += 1
-                    
-                    # Check if it's a Post Data
-                    elif 'postId' in item:
-                        print(f"✓ Processing post: {item['postId']}")
-                        post_insert = supabase.table('posts').upsert({
-                            'linkedin_post_id': item.get('postId'),
-                            'content': item.get('content', ''),
-                            'post_type': item.get('postType', ''),
-                            'published_at': item.get('publishedAt', ''),
-                            'author_id': item.get('authorId', ''),
-                            'hashtags': item.get('hashtags', []),
-                            'mentions': item.get('mentions', []),
-                            'raw_data': item
-                        }).execute()
-                        
-                        if post_insert.data and len(post_insert.data) > 0:
-                            post_id = post_insert.data[0]['id']
-                            supabase.table('engagement_metrics').insert({
-                                'post_id': post_id,
-                                'likes': item.get('likes', 0),
-                                'comments': item.get('comments', 0),
-                                'shares': item.get('shares', 0),
-                                'impressions': item.get('impressions', 0),
-                                'clicks': item.get('clicks', 0),
-                                'engagement_rate': calculate_engagement_rate(item),
-                                'measured_at': datetime.utcnow().isoformat()
-                            }).execute()
-                            print(f"✓ Post and Engagement Data Saved for Post ID: {post_id}")
-                            processed_items += 1
-                        else:
-                            print("⚠ Warning: No data returned from post insert")
-                    else:
-                        print(f"⚠ Unknown item type in item {i+1}")
-                    
-                except Exception as item_error:
-                    print(f"✗ Error processing item {i+1}: {item_error}")
-                    continue
-            
-            print(f"✓ JSON Webhook completed: {processed_items} items processed")
+            if not enqueue_webhook_job('JSON', result_data, event_id):
+                return jsonify({'status': 'error', 'message': 'Webhook queue is full, retry later'}), 503
+
+            logger.info("✓ JSON Webhook queued: %d items", len(result_data))
             return jsonify({
-                'status': 'success', 
-                'message': f'JSON processed: {processed_items} items saved',
-                'processed_count': processed_items,
+                'status': 'queued', 
+                'message': f'JSON queued: {len(result_data)} items',
+                'queued_count': len(result_data),
                 'format': 'JSON'
-            }), 200
+            }), 202
         
         else:
-            print("✗ No recognized data format found")
-            print("Available keys:", list(data.keys()))
+            logger.warning("✗ No recognized data format found. Available keys: %s", list(data.keys()))
             return jsonify({
                 'status': 'error', 
                 'message': 'No CSV URL or resultObject found in webhook data',
@@ -566,18 +1289,23 @@ def webhook():
             }), 400
         
     except Exception as e:
-        print(f"✗ Webhook error: {e}")
+        logger.exception("✗ Webhook error: %s", e)
         return jsonify({'status': 'error', 'message': 'Internal server error'}), 500
 
 # Error handlers
 @app.errorhandler(404)
 def not_found(error):
-    print(f"404 error: {error}")
+    logger.info("404 error: %s", error)
     return jsonify({'status': 'error', 'message': 'Endpoint not found'}), 404
 
+@app.errorhandler(413)
+def payload_too_large(error):
+    logger.warning("413 error: %s", error)
+    return jsonify({'status': 'error', 'message': 'Payload too large'}), 413
+
 @app.errorhandler(500)
 def internal_error(error):
-    print(f"500 error: {error}")
+    logger.error("500 error: %s", error)
     return jsonify({'status': 'error', 'message': 'Internal server error'}), 500
 
 print("✓ Complete Flask webhook ready - supports JSON, CSV, and Phantom management!")
@@ -0,0 +1,6 @@
+# Gunicorn entrypoint. gevent must patch the stdlib (sockets, ssl, threading)
+# before anything imports them, so it runs ahead of the app import.
+from gevent import monkey
+monkey.patch_all()
+
+from app.main import app  # noqa: E402
@@ -0,0 +1,16 @@
+# Gunicorn settings, loaded automatically from the working directory.
+# The bind address stays in the Procfile so Railway's $PORT is expanded there.
+import multiprocessing
+import os
+
+# Import the app once in the master; workers create their own Supabase
+# client lazily after the fork (see get_supabase in app/main.py)
+preload_app = True
+
+# Webhook handling is almost entirely waiting on PhantomBuster and Supabase,
+# so each worker serves many requests as gevent greenlets. Keep
+# workers * SUPABASE_POOL_SIZE under the Supabase connection limit.
+worker_class = 'gevent'
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+worker_connections = int(os.getenv('WORKER_CONNECTIONS', '200'))
+keepalive = 30
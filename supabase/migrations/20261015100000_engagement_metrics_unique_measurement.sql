@@ -0,0 +1,13 @@
+-- One engagement_metrics row per post per measurement, so a batch whose
+-- write is retried can be upserted with ignore-duplicates instead of
+-- inserted twice. measured_at is stamped when a delivery is processed, so a
+-- redelivered webhook is a new measurement; webhook_events is what skips
+-- those. Drop existing exact duplicates first or the index can't be built.
+delete from engagement_metrics a
+using engagement_metrics b
+where a.post_id = b.post_id
+  and a.measured_at = b.measured_at
+  and a.ctid > b.ctid;
+
+create unique index if not exists engagement_metrics_post_id_measured_at_key
+  on engagement_metrics (post_id, measured_at);
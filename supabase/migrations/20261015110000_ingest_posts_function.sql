@@ -0,0 +1,41 @@
+-- Upsert a batch of posts and insert their engagement_metrics rows in one
+-- round-trip and one transaction. Each payload item is a posts row merged
+-- with its metrics row (minus post_id), as sent by the webhook when
+-- SUPABASE_INGEST_RPC=1. Returns one row whose saved column is how many
+-- posts were written, since the PostgREST client expects rows, not a scalar.
+-- Dropped first: create or replace can't change an existing return type
+drop function if exists ingest_posts(jsonb);
+
+create function ingest_posts(payload jsonb)
+returns table (saved integer)
+language plpgsql
+as $$
+begin
+  return query
+  with upserted as (
+    insert into posts (linkedin_post_id, content, post_type, published_at, author_id, hashtags, mentions, raw_data)
+    select linkedin_post_id, content, post_type, published_at, author_id, hashtags, mentions, raw_data
+    from jsonb_populate_recordset(null::posts, payload)
+    on conflict (linkedin_post_id) do update set
+      content = excluded.content,
+      post_type = excluded.post_type,
+      published_at = excluded.published_at,
+      author_id = excluded.author_id,
+      hashtags = excluded.hashtags,
+      mentions = excluded.mentions,
+      -- raw_data is only sent when STORE_RAW=1; keep what's stored otherwise
+      raw_data = coalesce(excluded.raw_data, posts.raw_data)
+    returning id, linkedin_post_id
+  ),
+  metrics as (
+    insert into engagement_metrics (post_id, likes, comments, shares, impressions, clicks, engagement_rate, measured_at)
+    select upserted.id, m.likes, m.comments, m.shares, m.impressions, m.clicks, m.engagement_rate, m.measured_at
+    from jsonb_array_elements(payload) as item
+    join upserted on upserted.linkedin_post_id = item->>'linkedin_post_id'
+    cross join lateral jsonb_populate_record(null::engagement_metrics, item) as m
+    on conflict (post_id, measured_at) do nothing
+    returning 1
+  )
+  select count(*)::integer from upserted;
+end;
+$$;
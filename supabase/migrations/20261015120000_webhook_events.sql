@@ -0,0 +1,12 @@
+-- Last processing time of each webhook delivery, keyed by a digest of its
+-- body, so a PhantomBuster retry of the same payload within
+-- WEBHOOK_DEDUPE_WINDOW is acknowledged but not written again.
+create table if not exists webhook_events (
+  event_id text primary key,
+  format text not null,
+  processed_at timestamptz not null default now()
+);
+
+-- The worker deletes rows that have left the window, once per window
+create index if not exists webhook_events_processed_at_idx
+  on webhook_events (processed_at);
@@ -0,0 +1,55 @@
+-- Derive engagement_rate in the database from the counters it's computed
+-- from, so the webhook stops sending it and it can't drift from its inputs.
+-- Clicks now count on every row; CSV imports used to leave them out.
+--
+-- Deploy order: ship the webhook that no longer sends engagement_rate first
+-- (it works against the old column too), then run this migration. Any code
+-- still sending the rate is rejected once the column is generated.
+alter table engagement_metrics drop column if exists engagement_rate;
+
+alter table engagement_metrics
+  add column engagement_rate numeric generated always as (
+    round(
+      (coalesce(likes, 0) + coalesce(comments, 0) + coalesce(shares, 0) + coalesce(clicks, 0))::numeric
+        / greatest(coalesce(impressions, 0), 1) * 100,
+      2
+    )
+  ) stored;
+
+-- A generated column can't be written, so ingest_posts stops passing it on.
+-- Dropped first so this also applies over a copy returning a bare integer.
+drop function if exists ingest_posts(jsonb);
+
+create function ingest_posts(payload jsonb)
+returns table (saved integer)
+language plpgsql
+as $$
+begin
+  return query
+  with upserted as (
+    insert into posts (linkedin_post_id, content, post_type, published_at, author_id, hashtags, mentions, raw_data)
+    select linkedin_post_id, content, post_type, published_at, author_id, hashtags, mentions, raw_data
+    from jsonb_populate_recordset(null::posts, payload)
+    on conflict (linkedin_post_id) do update set
+      content = excluded.content,
+      post_type = excluded.post_type,
+      published_at = excluded.published_at,
+      author_id = excluded.author_id,
+      hashtags = excluded.hashtags,
+      mentions = excluded.mentions,
+      -- raw_data is only sent when STORE_RAW=1; keep what's stored otherwise
+      raw_data = coalesce(excluded.raw_data, posts.raw_data)
+    returning id, linkedin_post_id
+  ),
+  metrics as (
+    insert into engagement_metrics (post_id, likes, comments, shares, impressions, clicks, measured_at)
+    select upserted.id, m.likes, m.comments, m.shares, m.impressions, m.clicks, m.measured_at
+    from jsonb_array_elements(payload) as item
+    join upserted on upserted.linkedin_post_id = item->>'linkedin_post_id'
+    cross join lateral jsonb_populate_record(null::engagement_metrics, item) as m
+    on conflict (post_id, measured_at) do nothing
+    returning 1
+  )
+  select count(*)::integer from upserted;
+end;
+$$;